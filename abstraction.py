@@ -0,0 +1,143 @@
+from pysmt.shortcuts import *
+from query_trace import is_sat, is_sat_incremental
+
+
+class PredicateAbstraction:
+    """
+    A predicate-abstraction domain over a fixed, finite set of atomic
+    predicates. Assertions in this domain are disjunctions of cubes, where a
+    cube is a conjunction of literals (predicates or their negations).
+
+    Images are computed by Cartesian abstraction: a literal is included in the
+    abstract image of a cube iff the cube entails it. This needs only
+    entailment checks, never quantifier elimination, so the cost of computing
+    an image is bounded by the number of predicates. Joins and inclusion
+    checks are purely syntactic, and since the set of cubes over a finite
+    predicate set is finite, the fixpoint iteration is guaranteed to terminate.
+    """
+    def __init__(self, predicates):
+        # The fixed list of atomic predicates this domain is built over.
+        self.predicates = predicates
+        # Memoised results of abstract_cube. Formulas are hash-consed by pysmt,
+        # so they can be used directly as keys.
+        self.cube_cache = {}
+
+    def abstract(self, formula):
+        """
+        Returns the abstraction of the given concrete formula. Each top-level
+        disjunct is abstracted separately, so disjunctions in the formula are
+        preserved where possible.
+        """
+        if formula.is_implies():
+            formula = Or(Not(formula.arg(0)), formula.arg(1))
+        disjuncts = formula.args() if formula.is_or() else [formula]
+        cubes = [self.abstract_cube(d) for d in disjuncts]
+        return from_cubes(c for c in cubes if c is not None)
+
+    def abstract_cube(self, formula, substitution=None, excluded_vars=()):
+        """
+        Returns the Cartesian abstraction of the given formula as a cube: the
+        set of literals l such that formula ==> l[substitution]. Predicates
+        mentioning any of the excluded variables are ignored. Returns None if
+        the formula is unsatisfiable.
+
+        Entailment checks are avoided where the answer is known in advance: a
+        literal of the formula itself is entailed, a predicate that becomes
+        constant under the substitution is decided by simplification, and a
+        satisfiable formula cannot entail a predicate over none of its
+        variables.
+        """
+        key = (formula, frozenset(substitution.items()) if substitution
+               else None, frozenset(excluded_vars))
+        if key in self.cube_cache:
+            return self.cube_cache[key]
+        cube = None
+        # All checks share one solver on which the formula is asserted.
+        with Solver(name='z3') as solver:
+            solver.add_assertion(formula)
+            if is_sat_incremental(solver, TRUE(), formula):
+                cube = frozenset(self.get_entailed_literals(
+                    solver, formula, substitution, excluded_vars))
+        self.cube_cache[key] = cube
+        return cube
+
+    def get_entailed_literals(self, solver, formula, substitution,
+                              excluded_vars):
+        excluded = set(excluded_vars)
+        variables = formula.get_free_variables()
+        literals = set(formula.args()) if formula.is_and() else {formula}
+        for p in self.predicates:
+            if excluded & p.get_free_variables():
+                continue
+            q = p.substitute(substitution) if substitution else p
+            q_variables = q.get_free_variables()
+            if q in literals:
+                yield p
+            elif Not(q) in literals:
+                yield Not(p)
+            elif not q_variables:
+                yield p if simplify(q).is_true() else Not(p)
+            elif not variables & q_variables:
+                continue
+            elif not is_sat_incremental(solver, Not(q), formula):
+                yield p
+            elif not is_sat_incremental(solver, q, formula):
+                yield Not(p)
+
+    def image(self, pred, constraint=None, substitution=None,
+              excluded_vars=()):
+        """
+        Abstracts each cube of the abstract predicate 'pred', conjoined with
+        the concrete constraint if given, under the given substitution.
+        """
+        cubes = []
+        for c in to_cubes(pred):
+            body = And(And(c), constraint) if constraint else And(c)
+            cube = self.abstract_cube(body, substitution,
+                                      excluded_vars)
+            if cube is not None:
+                cubes.append(cube)
+        return from_cubes(cubes)
+
+    @staticmethod
+    def includes(pred, other):
+        """
+        Returns True iff every cube of 'other' is subsumed by some cube of
+        'pred', which is a sufficient condition for other ==> pred.
+        """
+        pred_cubes = to_cubes(pred)
+        return all(any(c <= d for c in pred_cubes) for d in to_cubes(other))
+
+    @staticmethod
+    def join(pred, other):
+        return from_cubes(to_cubes(pred) + to_cubes(other))
+
+
+def to_cubes(pred):
+    """
+    Decomposes an abstract predicate, as built by from_cubes, into its list of
+    cubes. Each cube is a frozenset of literals.
+    """
+    if pred.is_false():
+        return []
+    cubes = []
+    for d in (pred.args() if pred.is_or() else [pred]):
+        if d.is_true():
+            cubes.append(frozenset())
+        elif d.is_and():
+            cubes.append(frozenset(d.args()))
+        else:
+            cubes.append(frozenset([d]))
+    return cubes
+
+
+def from_cubes(cubes):
+    """
+    Builds an abstract predicate from the given cubes. Cubes subsumed by a
+    weaker cube are dropped, and the remaining cubes and literals are sorted so
+    that equal sets of cubes always produce the same formula.
+    """
+    cubes = set(cubes)
+    minimal = [c for c in cubes if not any(d < c for d in cubes)]
+    disjuncts = [And(sorted(c, key=str)) for c in minimal]
+    return Or(sorted(disjuncts, key=str))
@@ -0,0 +1,162 @@
+import pysmt.shortcuts
+from pysmt.shortcuts import *
+from pysmt.parsing import parse
+from pysmt.smtlib.parser import SmtLibParser
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from thread import *
+from query_trace import to_smtlib_script
+import json
+import re
+
+
+def get_statements(block):
+    """
+    Returns the statements in the given block in the order they appear in a
+    proof outline, i.e. the order of main.recurse_cfg.
+    """
+    statements = []
+    for stmt in block:
+        statements.append(stmt)
+        if isinstance(stmt, Conditional):
+            statements.extend(get_statements(stmt.true_block))
+            statements.extend(get_statements(stmt.false_block))
+    return statements
+
+
+def load_outline(threads: list[Procedure], filename):
+    """
+    Loads the preconditions of a proof outline into the statements of the given
+    threads. The outline is either the text printed by main.py, as generated by
+    Procedure.get_proof_str, or a JSON file as written by save_outline.
+    """
+    with open(filename, 'r') as reader:
+        if filename.endswith('.json'):
+            outline = json.load(reader)
+        else:
+            outline = read_outline_text(reader)
+    for t in threads:
+        statements = get_statements(t.block) + [t.eof]
+        annotations = outline.get(t.name, [])
+        if len(annotations) != len(statements):
+            raise ProgramError(f'The outline of procedure {t.name} does not '
+                               f'match the program.')
+        for stmt, annotation in zip(statements, annotations):
+            stmt.pre = parse(annotation)
+
+
+def read_outline_text(reader):
+    """
+    Returns a dictionary mapping each procedure name in a printed proof outline
+    to its list of annotations, in order. Every annotation is on its own line,
+    after the '|' that separates it from the program counter column.
+    """
+    outline = {}
+    annotations = None
+    for line in reader:
+        header = re.match(r'\s*procedure (\w+)\(\) {', line)
+        if header:
+            annotations = outline.setdefault(header.group(1), [])
+        elif line.strip() == '}':
+            annotations = None
+        elif annotations is not None and '|' in line:
+            content = line.split('|', 1)[1].strip()
+            if content.startswith('{') and content.endswith('}'):
+                annotations.append(content[1:-1])
+    return outline
+
+
+def save_outline(threads: list[Procedure], filename):
+    """
+    Writes the preconditions of the given threads to a JSON proof outline.
+    """
+    outline = {}
+    for t in threads:
+        statements = get_statements(t.block) + [t.eof]
+        outline[t.name] = [s.pre.serialize() for s in statements]
+    with open(filename, 'w') as writer:
+        json.dump(outline, writer, indent=4)
+
+
+def get_obligations(threads: list[Procedure], precondition, postcondition):
+    """
+    Returns the list of proof obligations of the loaded proof outline, as
+    (description, formula) pairs, where each formula must be valid.
+
+    Sequential validity requires the postcondition of each statement, derived
+    from its loaded precondition, to entail the precondition of the next.
+    Stability requires the image of each interfering assignment on a
+    precondition to entail it. Unlike regenerate_proof, nothing is weakened and
+    no fixpoint is computed. Postconditions and images are left unreduced, so
+    that their quantifier elimination is also done by the workers.
+    """
+    obligations = []
+
+    def add(description, antecedent, consequent):
+        obligations.append((description, Implies(antecedent, consequent)))
+
+    def add_stability(stmt, location):
+        for assign in stmt.thread.interfering_assignments:
+            image = And(assign.get_sp_interfere_formula(stmt.pre),
+                        assign.reachable_pcs)
+            add(f'stability of the precondition {location} under '
+                f'{assign.thread.name} PC {assign.pc} ({assign})',
+                image, stmt.pre)
+
+    def add_block(block, incoming):
+        # Returns the postcondition of the block.
+        for stmt in block:
+            location = f'at {stmt.thread.name} PC {stmt.pc} ({stmt})'
+            add(f'sequential validity of the precondition {location}',
+                incoming, stmt.pre)
+            add_stability(stmt, location)
+            if isinstance(stmt, Assertion):
+                add(f'the assertion {location}', stmt.pre, stmt.cond)
+            if isinstance(stmt, Conditional):
+                true_post = add_block(stmt.true_block,
+                                      And(stmt.pre, stmt.cond))
+                false_post = add_block(stmt.false_block,
+                                       And(stmt.pre, Not(stmt.cond)))
+                stmt.update_block_postconditions(true_post, false_post)
+            incoming = stmt.get_sp_formula()
+        return incoming
+
+    for t in threads:
+        post = add_block(t.block, precondition)
+        location = f'at the end of {t.name}'
+        add(f'sequential validity of the precondition {location}',
+            post, t.eof.pre)
+        add_stability(t.eof, location)
+    add('the specified postcondition', And([t.eof.pre for t in threads]),
+        postcondition)
+    return obligations
+
+
+def check_obligation(script):
+    """
+    Returns True iff the obligation in the given SMT-LIB script is valid. Its
+    quantifiers are eliminated first. This runs in a worker process, so the
+    queries are not recorded.
+    """
+    formula = SmtLibParser().get_script(StringIO(script)).get_last_formula()
+    if not get_env().qfo.is_qf(formula):
+        formula = pysmt.shortcuts.qelim(formula, 'z3')
+    return not pysmt.shortcuts.is_sat(Not(formula))
+
+
+def check_obligations(obligations, jobs=None):
+    """
+    Discharges the given obligations in parallel, using the given number of
+    worker processes. Returns the description of the first failing obligation,
+    or None if all of them hold. Formulas are passed to the workers as SMT-LIB
+    scripts, since pysmt formulas are tied to the environment that created
+    them.
+    """
+    scripts = [to_smtlib_script(formula) for _, formula in obligations]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for (description, _), valid in \
+                zip(obligations, executor.map(check_obligation, scripts)):
+            if not valid:
+                executor.shutdown(cancel_futures=True)
+                return description
+    return None
@@ -1,16 +1,103 @@
 from parser import *
 from thread import *
+from abstraction import PredicateAbstraction
+from checker import load_outline, save_outline, get_obligations, \
+    check_obligations
+from query_trace import is_sat, is_valid, qelim, set_context, \
+    start_recording, stop_recording
 from lark import Lark
-import sys
+from lark.exceptions import LarkError, UnexpectedInput
+from pysmt.environment import push_env, pop_env
+from contextlib import contextmanager
+from itertools import islice
+import argparse
+import re
+import resource
 from colorama import Fore
 
 
 def main():
-    if len(sys.argv) != 2:
-        print('Usage: main.py filename')
+    arg_parser = argparse.ArgumentParser(prog='main.py')
+    arg_parser.add_argument('filename')
+    arg_parser.add_argument('--abstract', action='store_true',
+                            help='analyse over a fixed set of predicates, '
+                                 'trading precision for speed')
+    arg_parser.add_argument('--parse-order', action='store_true',
+                            help='analyse threads in parse order, rather than '
+                                 'scheduling them by interference')
+    arg_parser.add_argument('--batch-stability', action='store_true',
+                            help='check stability against all interfering '
+                                 'assignments with one solver call')
+    arg_parser.add_argument('--trace', metavar='FILE',
+                            help='record every solver query to an SMT-LIB 2 '
+                                 'trace, for use with replay.py')
+    arg_parser.add_argument('--check', metavar='OUTLINE',
+                            help='check the given proof outline instead of '
+                                 'deriving one')
+    arg_parser.add_argument('--jobs', type=int, metavar='N',
+                            help='the number of processes used by --check')
+    arg_parser.add_argument('--save-outline', metavar='FILE',
+                            help='write the derived proof outline to a JSON '
+                                 'file that --check can load')
+    arg_parser.add_argument('--early-exit', action='store_true',
+                            help='check assertions and the postcondition '
+                                 'after every sweep, and stop at the first '
+                                 'violation')
+    arg_parser.add_argument('--hint', action='append', default=[],
+                            metavar='PREDICATE',
+                            help='an extra predicate for --abstract mode')
+    args = arg_parser.parse_args()
+
+    # Programs are read from the file one at a time, and each is parsed and
+    # analysed in its own pysmt environment, so that the formulas interned
+    # during its analysis are freed once it is done.
+    programs = read_programs(args.filename)
+    if args.check or args.save_outline:
+        # Look ahead before anything is verified or written.
+        first_programs = list(islice(programs, 2))
+        if len(first_programs) > 1:
+            exit('Error: --check and --save-outline require a file containing '
+                 'a single program.')
+        programs = iter(first_programs)
+    if args.trace:
+        start_recording(args.trace)
+    lark = Lark(grammar, parser='lalr')
+    successes = 0
+    count = 0
+    for line, text in programs:
+        count += 1
+        print(f'Program {count} (line {line}):')
+        with scoped_environment():
+            # A malformed or rejected program fails on its own, without
+            # stopping the rest.
+            try:
+                program = parse_program(lark, text, line)
+            except LarkError as e:
+                print(str(e).strip())
+                print(f'{Fore.RED}Verification Unsuccessful: Could not parse '
+                      f'the program.{Fore.RESET}')
+                program = None
+            try:
+                if program and verify_program(program, args):
+                    successes += 1
+            except ProgramError as e:
+                print(f'{Fore.RED}Verification Unsuccessful: {e}{Fore.RESET}')
+        print()
+    stop_recording()
+    if count > 1:
+        print(f'{successes} of {count} programs verified.')
+        print()
+    print(f'Peak Memory Usage: {get_peak_memory_mib():.1f} MiB')
+    if args.check:
+        print(f'Peak Memory Usage of the Largest Worker: '
+              f'{get_peak_memory_mib(resource.RUSAGE_CHILDREN):.1f} MiB')
 
-    # Parse test file.
-    program = parse_test_file(sys.argv[1])
+
+def verify_program(program, args):
+    """
+    Analyses a parsed program and reports its proof outline and whether it
+    satisfies its specified postcondition. Returns True iff it does.
+    """
     specified_precondition = program[0]
     specified_postcondition = program[1]
     global_variables = program[2]
@@ -32,34 +119,158 @@ def main():
     init_local_vars(threads, global_variables)
     # Verify that all local and global variable names are legal.
     verify_variable_names(threads, global_variables)
+    # Select how each thread checks the stability of its assertions.
+    for t in threads:
+        t.batched_stability = args.batch_stability
+
+    # Check the supplied proof outline, rather than deriving one.
+    if args.check:
+        load_outline(threads, args.check)
+        failure = check_obligations(get_obligations(
+            threads, specified_precondition, specified_postcondition),
+            args.jobs)
+        print()
+        if failure:
+            print(f'{Fore.RED}Proof Check Failed: {failure}.{Fore.RESET}')
+            return False
+        print(f'{Fore.GREEN}Proof Check Successful!{Fore.RESET}')
+        return True
+
+    # Order the threads such that writers are analysed before their readers.
+    if args.parse_order:
+        schedule = [threads]
+    else:
+        schedule = get_thread_schedule(threads, global_variables,
+                                       specified_precondition)
 
     # Perform analysis.
+    if args.abstract:
+        hints = [parse_predicate(h) for h in args.hint]
+        domain = PredicateAbstraction(get_predicates(
+            threads, specified_precondition, specified_postcondition, hints))
+        initial_pre = domain.abstract(specified_precondition)
     fixpoint_reached = False
-    while not fixpoint_reached:
+    violation = None
+    sweep = 0
+    while not fixpoint_reached and not violation:
         fixpoint_reached = True
-        for t in threads:
-            t.regenerate_proof(specified_precondition)
-            if not t.fixpoint_reached:
-                fixpoint_reached = False
+        sweep += 1
+        set_context(sweep=sweep)
+        # Bring each strongly connected component to a local fixpoint before
+        # moving on to the components that read from it. The global fixpoint
+        # is only reached once a full pass changes no thread.
+        for component in schedule:
+            component_fixpoint_reached = False
+            while not component_fixpoint_reached and not violation:
+                component_fixpoint_reached = True
+                for t in component:
+                    if args.abstract:
+                        t.regenerate_abstract_proof(initial_pre, domain)
+                    else:
+                        t.regenerate_proof(specified_precondition)
+                    if not t.fixpoint_reached:
+                        component_fixpoint_reached = False
+                        fixpoint_reached = False
+                # Preconditions only ever grow, so a violation found now is
+                # also a violation at the fixpoint.
+                if args.early_exit:
+                    violation = get_violation(threads, specified_postcondition)
+            if violation:
+                break
+    set_context(thread=None, pc=None)
+    if not violation:
+        violation = get_violation(threads, specified_postcondition)
     local_posts = [t.eof.pre for t in threads]
     program_post = And(local_posts)
 
+    if args.save_outline:
+        save_outline(threads, args.save_outline)
+
     for t in threads:
         print()
         print(t.get_proof_str())
     print()
     print('Derived Postcondition: ' + str(simplify(program_post).serialize()))
     print()
-    if is_sat(And(program_post, Not(specified_postcondition))):
-        print(f'{Fore.RED}Verification Unsuccessful.{Fore.RESET}')
-    else:
-        print(f'{Fore.GREEN}Verification Successful!{Fore.RESET}')
+    if violation:
+        if not fixpoint_reached:
+            print(f'Stopped early in sweep {sweep}.')
+        print(f'{Fore.RED}Verification Unsuccessful: Violated {violation}.'
+              f'{Fore.RESET}')
+        return False
+    print(f'{Fore.GREEN}Verification Successful!{Fore.RESET}')
+    return True
 
 
-def parse_test_file(filename):
-    lark = Lark(grammar, parser='lalr', transformer=Transform())
+def read_programs(filename):
+    """
+    Yields the text of each program in the given file, along with the line it
+    starts on. A file may contain any number of programs, each beginning with
+    its precondition. The file is read lazily, so that only one program is held
+    in memory at a time, and the analysis of a program can begin before the
+    rest of the file has been read.
+    """
+    lines = []
+    start = 1
     with open(filename, 'r') as reader:
-        return lark.parse(reader.read()).children[0]
+        for number, line in enumerate(reader, 1):
+            if re.match(r'\s*precondition\s*:', line) and lines:
+                yield start, ''.join(lines)
+                lines = []
+                start = number
+            lines.append(line)
+    if lines:
+        yield start, ''.join(lines)
+
+
+def parse_program(lark, text, line=1):
+    """
+    Parses the text of a single program, which starts on the given line of its
+    file. A new transformer is used for each program, so that thread ids are
+    allocated from 1 in every program.
+    """
+    try:
+        return Transform().transform(lark.parse(text)).children[0]
+    except UnexpectedInput as e:
+        # Report the position of the error in the file, not in the program.
+        if isinstance(e.line, int) and e.line > 0:
+            e.line += line - 1
+        raise
+
+
+@contextmanager
+def scoped_environment():
+    """
+    Runs the enclosed block in a fresh pysmt environment, which is discarded
+    on exit along with every formula and symbol created within it.
+    """
+    push_env()
+    try:
+        yield
+    finally:
+        pop_env()
+        reset_fresh_symbol_pool()
+
+
+def get_peak_memory_mib(who=resource.RUSAGE_SELF):
+    """
+    Returns the peak resident memory in MiB of this process, or with
+    RUSAGE_CHILDREN, that of the largest of its terminated child processes,
+    such as the workers of --check. The two peaks are reported separately,
+    since they are reached at different times, and a forked worker also counts
+    the pages it shares with this process. On Linux, ru_maxrss is measured in
+    KiB.
+    """
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def parse_predicate(text):
+    """
+    Parses a single boolean expression, such as a predicate hint supplied on
+    the command line.
+    """
+    lark = Lark(grammar, parser='lalr', transformer=Transform(), start='impl')
+    return lark.parse(text)
 
 
 def recurse_cfg(node, function):
@@ -246,8 +457,8 @@ def init_local_vars(threads: list[Procedure], global_vars):
                     if symbol_in(v, t2.local_vars):
                         duplicate = v
     if duplicate:
-        exit(f'Error: Duplicate local variable: {str(duplicate)}.\n'
-             f'Local variables must be distinct.')
+        raise ProgramError(f'Duplicate local variable: {str(duplicate)}. '
+                           f'Local variables must be distinct.')
 
 
 def verify_variable_names(threads: list[Procedure], global_vars):
@@ -266,7 +477,125 @@ def verify_variable_names(threads: list[Procedure], global_vars):
                 print(f'Variable {str(v)} has an illegal name.')
                 illegal_vars = True
     if illegal_vars:
-        exit('Error: Discovered a variable with an illegal name.')
+        raise ProgramError('Discovered a variable with an illegal name.')
+
+
+def get_violation(threads: list[Procedure], postcondition):
+    """
+    Returns a description of the first assertion whose condition is not implied
+    by its precondition, or failing that, the specified postcondition if it is
+    not implied by the derived one. Returns None if there is no violation.
+    """
+    violation = [None]
+
+    def assertion_checker(node):
+        if violation[0] is None and isinstance(node, Assertion) and \
+                is_sat(And(node.pre, Not(node.cond))):
+            violation[0] = \
+                f'the assertion at {node.thread.name} PC {node.pc} ({node})'
+
+    for t in threads:
+        recurse_cfg(t, assertion_checker)
+    if violation[0] is None and \
+            is_sat(And(And([t.eof.pre for t in threads]), Not(postcondition))):
+        violation[0] = 'the specified postcondition'
+    return violation[0]
+
+
+def get_thread_schedule(threads: list[Procedure], global_vars, precondition):
+    """
+    Returns the strongly connected components of the interference graph, in an
+    order such that writers precede their readers.
+
+    The interference graph has an edge from thread t to thread t2 iff t assigns
+    to a global variable that appears in the assertions of t2. These are the
+    variables appearing in t2, along with those of the specified precondition,
+    which is the first assertion of every thread. Interference only flows along
+    these edges, so analysing the components in topological order means that
+    each component is stabilised against its writers before it is analysed,
+    and loosely coupled threads converge in few passes. Threads within a
+    component are kept in parse order.
+    """
+    writes = {}
+    mentions = {}
+
+    def get_vars(node):
+        if isinstance(node, Assignment):
+            variables = {node.left} | node.right.get_free_variables()
+            if node.left in global_vars:
+                writes[t].add(node.left)
+        else:
+            variables = node.cond.get_free_variables()
+        mentions[t].update(variables)
+
+    for t in threads:
+        writes[t] = set()
+        mentions[t] = set(precondition.get_free_variables())
+        recurse_cfg(t, get_vars)
+    successors = {t: [t2 for t2 in threads if t2 != t and
+                      writes[t] & mentions[t2]] for t in threads}
+
+    # Tarjan's algorithm, which yields components in reverse topological order.
+    index = {}
+    low_link = {}
+    stack = []
+    components = []
+
+    def strong_connect(t):
+        index[t] = low_link[t] = len(index)
+        stack.append(t)
+        for t2 in successors[t]:
+            if t2 not in index:
+                strong_connect(t2)
+                low_link[t] = min(low_link[t], low_link[t2])
+            elif t2 in stack:
+                low_link[t] = min(low_link[t], index[t2])
+        if low_link[t] == index[t]:
+            component = []
+            while True:
+                t2 = stack.pop()
+                component.append(t2)
+                if t2 == t:
+                    break
+            components.append(sorted(component, key=threads.index))
+
+    for t in threads:
+        if t not in index:
+            strong_connect(t)
+    components.reverse()
+    return components
+
+
+def get_predicates(threads: list[Procedure], precondition, postcondition,
+                   hints):
+    """
+    Returns the fixed predicate set for predicate-abstraction mode. This is the
+    set of atoms appearing in the conditions of conditionals, assumptions and
+    assertions, in the specified pre- and postconditions, in the given hints,
+    and in the reachable-PC constraints of interfering global assignments. The
+    latter are needed to express the PC restrictions conjoined to interference
+    images, which is the only use of reachable PCs.
+    """
+    predicates = []
+    interfering = [a for t in threads for a in t.interfering_assignments]
+
+    def add_atoms(formula):
+        for atom in sorted(formula.get_atoms(), key=str):
+            if not atom.is_bool_constant() and atom not in predicates:
+                predicates.append(atom)
+
+    def predicate_miner(node):
+        if isinstance(node, Assignment):
+            if node in interfering:
+                add_atoms(node.reachable_pcs)
+        else:
+            add_atoms(node.cond)
+
+    for formula in [precondition, postcondition] + hints:
+        add_atoms(formula)
+    for t in threads:
+        recurse_cfg(t, predicate_miner)
+    return predicates
 
 # ======================= Helper Functions =======================
 
@@ -1,5 +1,6 @@
 from lark import Transformer
 from thread import *
+import sys
 
 
 grammar = """
@@ -182,35 +183,83 @@ class Transform(Transformer):
 
     @staticmethod
     def comp(args):
+        """
+        Comparisons are normalised to the form 'sum <= c', 'sum == c' or
+        'sum != c', where sum is the linear form of the left-hand side minus
+        the right-hand side, and c is a constant. Since all variables are
+        integers, strict inequalities become non-strict ones. Comparisons
+        between constants are folded to true or false.
+        """
         op = str(args[1])
-        if op == '<=':
-            return LE(args[0], args[2])
-        if op == '<':
-            return LT(args[0], args[2])
-        if op == '>=':
-            return GE(args[0], args[2])
-        if op == '>':
-            return GT(args[0], args[2])
+        coeffs, const = get_linear_form(args[0])
+        right_coeffs, right_const = get_linear_form(args[2])
+        coeffs, const = add_linear_forms(coeffs, const,
+                                         right_coeffs, right_const, -1)
+        # Now the comparison is between sum + const and 0.
+        if op in ['>=', '>']:
+            coeffs, const = add_linear_forms({}, 0, coeffs, const, -1)
+        if op in ['<', '>']:
+            const += 1
+        # Equalities and disequalities are symmetric, so they are normalised
+        # such that the leading coefficient is positive.
+        if op in ['==', '!='] and coeffs and \
+                coeffs[min(coeffs, key=str)] < 0:
+            coeffs, const = add_linear_forms({}, 0, coeffs, const, -1)
+        if not coeffs:
+            if op in ['==']:
+                return Bool(const == 0)
+            if op in ['!=']:
+                return Bool(const != 0)
+            return Bool(const <= 0)
+        left = from_linear_form(coeffs, 0)
         if op == '==':
-            return Equals(args[0], args[2])
+            return Equals(left, Int(-const))
         if op == '!=':
-            return NotEquals(args[0], args[2])
+            return NotEquals(left, Int(-const))
+        return LE(left, Int(-const))
 
     @staticmethod
     def a_expr(args):
+        """
+        Sums and differences are normalised to linear form, as per
+        from_linear_form.
+        """
         op = str(args[1])
-        if op == '+':
-            return Plus(args[0], args[2])
-        if op == '-':
-            return Minus(args[0], args[2])
+        coeffs, const = get_linear_form(args[0])
+        right_coeffs, right_const = get_linear_form(args[2])
+        sign = 1 if op == '+' else -1
+        return from_linear_form(*add_linear_forms(coeffs, const, right_coeffs,
+                                                  right_const, sign))
 
     @staticmethod
     def term(args):
+        """
+        Products with a constant factor are normalised to linear form, and
+        constant expressions are folded, with division following the Euclidean
+        semantics of SMT-LIB div. Products of two non-constant terms and
+        divisions by a non-constant term are nonlinear, and are reported, since
+        quantifier elimination may not support them.
+        """
         op = str(args[1])
+        left, right = args[0], args[2]
         if op == '*':
-            return Times(args[0], args[2])
-        if op == '/':
-            return Div(args[0], args[2])
+            if left.is_int_constant() or right.is_int_constant():
+                if right.is_int_constant():
+                    left, right = right, left
+                coeffs, const = get_linear_form(right)
+                return from_linear_form(*add_linear_forms(
+                    {}, 0, coeffs, const, left.constant_value()))
+            expr = Times(left, right)
+        else:
+            if right.is_int_constant():
+                if left.is_int_constant() and right.constant_value() != 0:
+                    return Int(euclidean_div(left.constant_value(),
+                                             right.constant_value()))
+                return Div(left, right)
+            expr = Div(left, right)
+        print(f'Warning: Nonlinear expression {expr.serialize()}.',
+              file=sys.stderr)
+        return expr
 
     @staticmethod
     def int_literal(args):
@@ -219,3 +268,63 @@ class Transform(Transformer):
     @staticmethod
     def variable(args):
         return Symbol(str(args[0]), INT)
+
+
+# ======================= Helper Functions =======================
+
+def euclidean_div(a, b):
+    """
+    Returns the quotient q of a and b such that a == b * q + r, where
+    0 <= r < |b|. This is the semantics of div in SMT-LIB.
+    """
+    return a // b if b > 0 else -(a // -b)
+
+
+def get_linear_form(term):
+    """
+    Returns the linear form of an arithmetic term, as a dictionary mapping each
+    of its variables to its coefficient, and a constant. Nonlinear subterms are
+    treated as variables.
+    """
+    if term.is_int_constant():
+        return {}, term.constant_value()
+    if term.is_plus():
+        coeffs, const = {}, 0
+        for arg in term.args():
+            arg_coeffs, arg_const = get_linear_form(arg)
+            coeffs, const = add_linear_forms(coeffs, const,
+                                             arg_coeffs, arg_const, 1)
+        return coeffs, const
+    if term.is_times() and len(term.args()) == 2 and \
+            term.arg(0).is_int_constant():
+        coeffs, const = get_linear_form(term.arg(1))
+        return add_linear_forms({}, 0, coeffs, const,
+                                term.arg(0).constant_value())
+    return {term: 1}, 0
+
+
+def add_linear_forms(coeffs, const, other_coeffs, other_const, factor):
+    """
+    Returns the linear form of (coeffs + const) + factor * (other_coeffs +
+    other_const). Variables whose coefficients become zero are dropped.
+    """
+    coeffs = dict(coeffs)
+    for v, c in other_coeffs.items():
+        coeffs[v] = coeffs.get(v, 0) + factor * c
+        if coeffs[v] == 0:
+            del coeffs[v]
+    return coeffs, const + factor * other_const
+
+
+def from_linear_form(coeffs, const):
+    """
+    Builds the canonical term of a linear form: a sum of the variables, ordered
+    by name and each multiplied by its coefficient unless it is 1, followed by
+    the constant unless it is 0.
+    """
+    terms = []
+    for v in sorted(coeffs, key=str):
+        terms.append(v if coeffs[v] == 1 else Times(Int(coeffs[v]), v))
+    if const != 0 or not terms:
+        terms.append(Int(const))
+    return terms[0] if len(terms) == 1 else Plus(terms)
@@ -0,0 +1,121 @@
+import pysmt.shortcuts
+from pysmt.shortcuts import And, Not
+from pysmt.smtlib.printers import to_smtlib
+import time
+
+
+class QueryRecorder:
+    """
+    Records solver queries to an SMT-LIB 2 trace file as they are issued.
+
+    Each query is written as a self-contained block, preceded by a comment
+    header holding its metadata, and followed by a (reset). Hence the trace can
+    be passed to z3 as is, and single blocks can be cut out as standalone
+    benchmarks. Satisfiability and validity queries end in (check-sat), where
+    a valid formula is recorded as its unsatisfiable negation. Quantifier
+    elimination queries end in z3's (apply qe).
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+        # The number of queries recorded so far.
+        self.count = 0
+        # The current position of the analysis, attached to each query.
+        self.context = {'thread': None, 'pc': None, 'sweep': None}
+
+    def record(self, kind, formula, result, elapsed):
+        self.count += 1
+        header = f'; query {self.count} kind={kind} result={result}'
+        for key, value in self.context.items():
+            header += f' {key}={value}'
+        header += f' time={elapsed:.6f}\n'
+        self.file.write(header)
+        if kind == 'is_valid':
+            formula = Not(formula)
+        self.file.write(to_smtlib_script(formula))
+        self.file.write('(apply qe)\n' if kind == 'qelim' else '(check-sat)\n')
+        self.file.write('(reset)\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def to_smtlib_script(formula):
+    """
+    Returns the SMT-LIB 2 declarations of the free variables of the given
+    formula, followed by an assertion of the formula.
+    """
+    script = ''
+    for s in sorted(formula.get_free_variables(), key=str):
+        script += f'(declare-fun {to_smtlib(s, daggify=False)} ' \
+                  f'{s.symbol_type().as_smtlib(funstyle=True)})\n'
+    script += f'(assert {to_smtlib(formula, daggify=False)})\n'
+    return script
+
+
+# The active recorder, or None if queries are not being recorded.
+recorder = None
+
+
+def start_recording(filename):
+    global recorder
+    recorder = QueryRecorder(filename)
+
+
+def stop_recording():
+    global recorder
+    if recorder:
+        recorder.close()
+        recorder = None
+
+
+def set_context(**context):
+    """
+    Updates the metadata attached to subsequently recorded queries.
+    """
+    if recorder:
+        recorder.context.update(context)
+
+
+def timed_query(kind, function, formula, *args):
+    """
+    Issues the given query, recording it if a recorder is active.
+    """
+    if not recorder:
+        return function(formula, *args)
+    start = time.perf_counter()
+    result = function(formula, *args)
+    elapsed = time.perf_counter() - start
+    recorder.record(kind, formula, result if kind != 'qelim' else '-', elapsed)
+    return result
+
+
+def is_sat_incremental(solver, formula, base):
+    """
+    Checks the satisfiability of base && formula on a solver on which base is
+    already asserted, leaving the solver as it was. The query is recorded as
+    the standalone conjunction.
+    """
+    start = time.perf_counter()
+    solver.push()
+    solver.add_assertion(formula)
+    result = solver.solve()
+    solver.pop()
+    if recorder:
+        elapsed = time.perf_counter() - start
+        recorder.record('is_sat', And(base, formula), result, elapsed)
+    return result
+
+
+# Drop-in replacements for the pysmt shortcuts of the same names.
+
+def is_sat(formula):
+    return timed_query('is_sat', pysmt.shortcuts.is_sat, formula)
+
+
+def is_valid(formula):
+    return timed_query('is_valid', pysmt.shortcuts.is_valid, formula)
+
+
+def qelim(formula, solver_name=None):
+    return timed_query('qelim', pysmt.shortcuts.qelim, formula, solver_name)
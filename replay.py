@@ -0,0 +1,73 @@
+from pysmt.shortcuts import is_sat, qelim
+from pysmt.smtlib.parser import SmtLibParser
+from io import StringIO
+import argparse
+import time
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        prog='replay.py',
+        description='Re-runs the solver queries in a trace recorded by '
+                    'main.py --trace.')
+    arg_parser.add_argument('filename')
+    arg_parser.add_argument('--top', type=int, metavar='N',
+                            help='only replay the N slowest recorded queries')
+    arg_parser.add_argument('--solver', default='z3',
+                            help='the solver for is_sat and is_valid queries')
+    arg_parser.add_argument('--qelim', default='z3', metavar='METHOD',
+                            help='the quantifier elimination method for qelim '
+                                 'queries')
+    args = arg_parser.parse_args()
+
+    queries = read_trace(args.filename)
+    if args.top:
+        queries.sort(key=lambda q: q['time'], reverse=True)
+        queries = queries[:args.top]
+
+    recorded_total = 0
+    replayed_total = 0
+    for q in queries:
+        formula = SmtLibParser().get_script(StringIO(q['body'])) \
+            .get_last_formula()
+        start = time.perf_counter()
+        if q['kind'] == 'qelim':
+            qelim(formula, args.qelim)
+        else:
+            # Validity queries are recorded as their negation.
+            is_sat(formula, solver_name=args.solver)
+        elapsed = time.perf_counter() - start
+        recorded_total += q['time']
+        replayed_total += elapsed
+        print(f'query {q["query"]:>6} {q["kind"]:<8} '
+              f'thread={q["thread"]} pc={q["pc"]} sweep={q["sweep"]} '
+              f'recorded={q["time"]:.6f}s replayed={elapsed:.6f}s')
+    print()
+    print(f'Replayed {len(queries)} queries: '
+          f'recorded={recorded_total:.6f}s replayed={replayed_total:.6f}s')
+
+
+def read_trace(filename):
+    """
+    Returns the queries in the given trace as a list of dictionaries holding
+    the metadata from each query's header, and its declarations and assertion
+    as an SMT-LIB 2 string under 'body'.
+    """
+    queries = []
+    with open(filename, 'r') as reader:
+        for line in reader:
+            if line.startswith('; query'):
+                fields = line.split()
+                query = {'query': int(fields[2]), 'body': ''}
+                for field in fields[3:]:
+                    key, value = field.split('=', 1)
+                    query[key] = value
+                query['time'] = float(query['time'])
+                queries.append(query)
+            elif line.startswith('(declare-fun') or line.startswith('(assert'):
+                queries[-1]['body'] += line
+    return queries
+
+
+if __name__ == '__main__':
+    main()
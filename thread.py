@@ -1,10 +1,54 @@
 from pysmt.shortcuts import *
 from typing import List
+from abstraction import to_cubes, from_cubes
+from query_trace import is_sat, is_valid, qelim, set_context
 
 
 # Indent for printing proof outlines.
 INDENT = 4
 
+# Fresh integer symbols whose quantifier scope has been closed. A pooled symbol
+# only ever appears bound by the existential of an SP derivation, never free in
+# a stored precondition, so it can be safely reused by later derivations rather
+# than interning a new symbol for each one. Several unreduced existentials, such
+# as the obligations of checker.get_obligations, may bind the same symbol.
+fresh_symbol_pool = []
+
+
+def acquire_fresh_symbol():
+    """
+    Returns an unused fresh integer symbol, recycling one from the pool if
+    possible.
+    """
+    if fresh_symbol_pool:
+        return fresh_symbol_pool.pop()
+    return FreshSymbol(INT)
+
+
+def release_fresh_symbol(symbol):
+    """
+    Returns a fresh symbol to the pool once the existential binding it has been
+    built.
+    """
+    fresh_symbol_pool.append(symbol)
+
+
+def reset_fresh_symbol_pool():
+    """
+    Empties the pool. This must be called whenever the pysmt environment the
+    pooled symbols belong to is discarded.
+    """
+    fresh_symbol_pool.clear()
+
+
+class ProgramError(Exception):
+    """
+    Raised when a program is rejected before it can be analysed, such as for
+    a duplicate local variable. Only that program fails; the rest of the file
+    is still analysed.
+    """
+
+
 class Statement:
     """
     In this implementation, a procedure contains of a block of statements. All
@@ -28,6 +72,13 @@ class Statement:
         self.pc = -1
         # The thread this statement belongs to.
         self.thread = None
+        # The tentative precondition and interference version (see
+        # Procedure.interference_version) this statement was last visited
+        # with, and whether that visit left it, and any statements nested in
+        # it, unchanged. Together, these determine whether it can be skipped.
+        self.last_pre = None
+        self.last_interference_version = -1
+        self.clean = False
 
     def regenerate_proof(self, pre):
         """
@@ -50,7 +101,13 @@ class Statement:
         updated, regardless of whether the proof for the inner block was
         changed. This is OK, since the SP transformers for these statements are
         quite simple (e.g. they do not contain quantifiers).
+
+        If this statement is clean (see is_clean), none of the above can change
+        the proof, so the cached postcondition is returned immediately.
         """
+        if self.is_clean(pre):
+            return self.post
+        set_context(thread=self.thread.name, pc=self.pc)
         updated_pre = False
         # Check if the given precondition is weaker than the current one.
         if is_sat(And(pre, Not(self.pre))):
@@ -58,12 +115,16 @@ class Statement:
             self.pre = simplify(Or(self.pre, pre))
             updated_pre = True
         # Check stability.
-        for assign in self.thread.interfering_assignments:
-            image = assign.compute_sp_interfere(self.pre)
-            if is_sat(And(image, Not(self.pre))):
-                # Precondition is unstable - stabilise it.
-                self.pre = simplify(Or(self.pre, image))
+        if self.thread.batched_stability:
+            if self.stabilise_batched():
                 updated_pre = True
+        else:
+            for assign in self.thread.interfering_assignments:
+                image = assign.compute_sp_interfere(self.pre)
+                if is_sat(And(image, Not(self.pre))):
+                    # Precondition is unstable - stabilise it.
+                    self.pre = simplify(Or(self.pre, image))
+                    updated_pre = True
         # If the statement is a conditional, update the proofs of its blocks.
         if isinstance(self, Conditional):
             # Regenerate proof for the true-block.
@@ -84,15 +145,104 @@ class Statement:
         # If any statement's pre has been updated, a fixpoint is not reached.
         if updated_pre:
             self.thread.fixpoint_reached = False
+            self.thread.proof_version += 1
+        self.record_visit(pre, updated_pre)
+        return self.post
+
+    def is_clean(self, pre):
+        """
+        Returns True iff regenerating the proof of this statement cannot change
+        it. This is the case if its last visit changed neither it nor any
+        statement nested in it, and since then, neither its tentative
+        precondition nor the preconditions of any interfering assignments have
+        changed.
+        """
+        return self.clean and pre is self.last_pre and \
+            self.last_interference_version == self.thread.interference_version
+
+    def record_visit(self, pre, updated_pre):
+        self.last_pre = pre
+        self.last_interference_version = self.thread.interference_version
+        self.clean = not updated_pre
+        if isinstance(self, Conditional):
+            self.clean = self.clean and \
+                all(s.clean for s in self.true_block + self.false_block)
+
+    def stabilise_batched(self):
+        """
+        Stabilises the precondition against all interfering assignments at
+        once, returning True iff it was weakened.
+
+        The images of all interfering assignments are checked for stability
+        with a single solver call on their disjunction. Only if this fails are
+        the destabilising images located by bisection, after which the
+        precondition is weakened once by all of them together. Since nearly
+        every check is stable at the fixpoint, this usually replaces one solver
+        call per interfering assignment with a single call.
+        """
+        images = [assign.compute_sp_interfere(self.pre)
+                  for assign in self.thread.interfering_assignments]
+        unstable_images = get_unstable_images(images, self.pre)
+        if not unstable_images:
+            return False
+        self.pre = simplify(Or([self.pre] + unstable_images))
+        return True
+
+    def regenerate_abstract_proof(self, pre, domain):
+        """
+        The predicate-abstraction counterpart of regenerate_proof.
+
+        Preconditions are abstract predicates in the given domain (see
+        abstraction.PredicateAbstraction), so weakening is a syntactic join and
+        stability is checked by syntactic inclusion of the abstract
+        interference images. No quantifier elimination is performed.
+        """
+        if self.is_clean(pre):
+            return self.post
+        set_context(thread=self.thread.name, pc=self.pc)
+        updated_pre = False
+        if not domain.includes(self.pre, pre):
+            self.pre = domain.join(self.pre, pre)
+            updated_pre = True
+        for assign in self.thread.interfering_assignments:
+            image = assign.compute_abstract_sp_interfere(self.pre, domain)
+            if not domain.includes(self.pre, image):
+                self.pre = domain.join(self.pre, image)
+                updated_pre = True
+        if isinstance(self, Conditional):
+            true_post = domain.image(self.pre, self.cond)
+            for stmt in self.true_block:
+                true_post = stmt.regenerate_abstract_proof(true_post, domain)
+            false_post = domain.image(self.pre, Not(self.cond))
+            for stmt in self.false_block:
+                false_post = stmt.regenerate_abstract_proof(false_post, domain)
+            self.update_block_postconditions(true_post, false_post)
+            self.post = self.compute_abstract_sp(domain)
+        elif updated_pre:
+            self.post = self.compute_abstract_sp(domain)
+        if updated_pre:
+            self.thread.fixpoint_reached = False
+            self.thread.proof_version += 1
+        self.record_visit(pre, updated_pre)
         return self.post
 
     def compute_sp(self):
         return self.pre
 
+    def get_sp_formula(self):
+        """
+        Returns the postcondition of this statement, possibly with quantifiers
+        that compute_sp would eliminate.
+        """
+        return self.compute_sp()
+
+    def compute_abstract_sp(self, domain):
+        return self.pre
+
     def get_proof_str(self, annotations=True):
         proof_str = ''
         if annotations:
-            proof_str += '{' + str(self.pre) + '}\n'
+            proof_str += '{' + self.pre.serialize() + '}\n'
         proof_str += str(self)
         if isinstance(self, Conditional):
             proof_str += ' {'
@@ -113,6 +263,20 @@ class Statement:
         return proof_str
 
 
+def get_unstable_images(images, pred):
+    """
+    Returns the images that are not included in the given predicate, using a
+    single solver call if there are none, and bisecting otherwise.
+    """
+    if not images or not is_sat(And(Or(images), Not(pred))):
+        return []
+    if len(images) == 1:
+        return images
+    mid = len(images) // 2
+    return get_unstable_images(images[:mid], pred) + \
+        get_unstable_images(images[mid:], pred)
+
+
 class Procedure:
     def __init__(self, name: str, t_id, block: List[Statement]):
         # Human-readable name of this procedure.
@@ -129,13 +293,35 @@ class Procedure:
         self.local_vars = []
         # The environment instructions that may interfere with this thread.
         self.interfering_assignments = []
+        # True iff stability is checked for all interfering assignments at once.
+        self.batched_stability = False
+        # Incremented whenever the precondition of a statement in this thread
+        # is updated.
+        self.proof_version = 0
+        # The sum of the proof versions of the threads containing interfering
+        # assignments, as of the start of the current sweep of this thread. A
+        # statement's stability need only be rechecked if this has changed.
+        self.interference_version = 0
+
+    def update_interference_version(self):
+        interfering_threads = {a.thread for a in self.interfering_assignments}
+        self.interference_version = \
+            sum(t.proof_version for t in interfering_threads)
 
     def regenerate_proof(self, pre):
         self.fixpoint_reached = True
+        self.update_interference_version()
         for stmt in self.block:
             pre = stmt.regenerate_proof(pre)
         return self.eof.regenerate_proof(pre)
 
+    def regenerate_abstract_proof(self, pre, domain):
+        self.fixpoint_reached = True
+        self.update_interference_version()
+        for stmt in self.block:
+            pre = stmt.regenerate_abstract_proof(pre, domain)
+        return self.eof.regenerate_abstract_proof(pre, domain)
+
     def __str__(self):
         return "procedure " + self.name + "()"
 
@@ -168,7 +354,8 @@ class Procedure:
         proof_str = ' ' * std_length + str(self) + ' {' + body
         if annotations:
             proof_str += '\n' + ' ' * (std_length - 2) + '| '
-            proof_str += ' ' * INDENT + '{' + str(self.eof.pre) + '}'
+            proof_str += ' ' * INDENT
+            proof_str += '{' + self.eof.pre.serialize() + '}'
         proof_str += '\n' + ' ' * std_length + '}' + '\n'
         return proof_str
 
@@ -180,6 +367,9 @@ class Assignment(Statement):
         self.right = right  # an arithmetic expression or symbol
         # reachable instructions in the CFG, necessary for auxiliary variables
         self.reachable_pcs = TRUE()
+        # The cubes of the abstraction of reachable_pcs, in --abstract mode.
+        # Since reachable_pcs is constant, these are computed only once.
+        self.reachable_pc_cubes = None
 
     def __str__(self):
         return str(self.left) + " := " + str(self.right) + ";"
@@ -188,13 +378,21 @@ class Assignment(Statement):
         """
         sp(x := E, P) = exists y :: x == E[x <- y] && P[x <- y]
         """
-        y = FreshSymbol(INT)
-        body = And(Equals(self.left, self.right.substitute({self.left: y})),
-                   self.pre.substitute({self.left: y}))
-        eliminated = simplify(qelim(Exists([y], simplify(body)), 'z3'))
+        eliminated = simplify(qelim(self.get_sp_formula(), 'z3'))
         assert not eliminated.is_quantifier()
         return eliminated
 
+    def get_sp_formula(self):
+        """
+        Returns sp(x := E, P) before its quantifier is eliminated.
+        """
+        y = acquire_fresh_symbol()
+        body = And(Equals(self.left, self.right.substitute({self.left: y})),
+                   self.pre.substitute({self.left: y}))
+        existential = Exists([y], simplify(body))
+        release_fresh_symbol(y)
+        return existential
+
     def compute_sp_interfere(self, env_pred):
         """
         Where P = pre, Q = env_pred, L = thread.local_vars, R = reachable_pcs,
@@ -202,16 +400,53 @@ class Assignment(Statement):
         sp_interfere(x := E, A)
         = (exists y, L, pc :: x == E[x <- y] && A[x <- y] && pc == k) && R
         """
+        existential = self.get_sp_interfere_formula(env_pred)
+        eliminated = simplify(qelim(existential, 'z3'))
+        assert not eliminated.is_quantifier()
+        return And(eliminated, self.reachable_pcs)
+
+    def get_sp_interfere_formula(self, env_pred):
+        """
+        Returns the existential of sp_interfere(x := E, P && Q), before its
+        quantifiers are eliminated and R is conjoined.
+        """
         pc_symb = self.thread.pc_symb
-        y = FreshSymbol(INT)
+        y = acquire_fresh_symbol()
         quantified_vars = [y] + list(self.thread.local_vars) + [pc_symb]
         body = And([Equals(self.left, self.right.substitute({self.left: y})),
                     And(self.pre, env_pred).substitute({self.left: y}),
                     Equals(pc_symb, Int(self.pc))])
         existential = Exists(quantified_vars, simplify(body))
-        eliminated = simplify(qelim(existential, 'z3'))
-        assert not eliminated.is_quantifier()
-        return And(eliminated, self.reachable_pcs)
+        release_fresh_symbol(y)
+        return existential
+
+    def compute_abstract_sp(self, domain):
+        """
+        Cartesian abstraction of sp(x := E, P): for each cube C of P, the
+        literals l such that C ==> l[x <- E].
+        """
+        return domain.image(self.pre, substitution={self.left: self.right})
+
+    def compute_abstract_sp_interfere(self, env_pred, domain):
+        """
+        Cartesian abstraction of sp_interfere(x := E, P && Q). Literals over
+        L and pc are dropped rather than existentially eliminated, and R is
+        abstracted separately and conjoined to each resulting cube.
+        """
+        pc_symb = self.thread.pc_symb
+        excluded_vars = list(self.thread.local_vars) + [pc_symb]
+        if self.reachable_pc_cubes is None:
+            self.reachable_pc_cubes = \
+                to_cubes(domain.abstract(self.reachable_pcs))
+        pc_cubes = self.reachable_pc_cubes
+        cubes = []
+        for c in to_cubes(self.pre):
+            constraint = And(And(c), Equals(pc_symb, Int(self.pc)))
+            image = domain.image(env_pred, constraint,
+                                 {self.left: self.right}, excluded_vars)
+            for cube in to_cubes(image):
+                cubes.extend(cube | r for r in pc_cubes)
+        return from_cubes(cubes)
 
 
 class Assumption(Statement):
@@ -228,21 +463,30 @@ class Assumption(Statement):
         """
         return And(self.pre, self.cond)
 
+    def compute_abstract_sp(self, domain):
+        return domain.image(self.pre, self.cond)
+
 
 class Assertion(Statement):
     def __init__(self, cond):
         super().__init__()
         self.cond = cond
 
-    def pretty(self):
+    def __str__(self):
         return "assert " + str(self.cond) + ";"
 
+    def pretty(self):
+        return str(self)
+
     def compute_sp(self):
         """
         sp(assert E, P) = E ==> P
         """
         return simplify(Implies(self.cond, self.pre))
 
+    def compute_abstract_sp(self, domain):
+        return domain.join(domain.abstract(Not(self.cond)), self.pre)
+
 
 class Conditional(Statement):
     def __init__(self, cond, true_block: List[Statement],
@@ -271,6 +515,9 @@ class Conditional(Statement):
         """
         return Or(self.true_block_post, self.false_block_post)
 
+    def compute_abstract_sp(self, domain):
+        return domain.join(self.true_block_post, self.false_block_post)
+
 
 class Eof(Statement):
     def __init__(self):